@@ -7,11 +7,18 @@ import os
 import base64
 import json
 import io
+import threading
+import queue
+import time
+import tarfile
+import orjson
 from flask import Flask, request, jsonify
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 import tensorflow as tf
 from PIL import Image
 import numpy as np
+import cv2
 
 app = Flask(__name__)
 
@@ -19,6 +26,25 @@ app = Flask(__name__)
 PROJECT_ID = os.environ.get('GCP_PROJECT_ID')
 BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME', 'kenya-agri-farmwise-ml')
 MODEL_PATH = 'models/plant-disease-detector'
+MODEL_ARCHIVE = 'model.tar.gz'
+TFLITE_INT8_MODEL = 'model_int8.tflite'
+TFLITE_FP16_MODEL = 'model_fp16.tflite'
+# The stock tensorflow wheel doesn't ship the TFLite GPU delegate; see DEPLOYMENT_GUIDE.md
+TFLITE_GPU_DELEGATE = os.environ.get('TFLITE_GPU_DELEGATE', 'libtensorflowlite_gpu_delegate.so')
+
+# Gunicorn layout (set in the Dockerfile); every worker loads its own model and batcher
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 1))
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))
+
+# Request micro-batching; a worker never has more than SERVER_THREADS requests to batch
+BATCH_MAX_SIZE = min(int(os.environ.get('BATCH_MAX_SIZE', SERVER_THREADS)), SERVER_THREADS)
+BATCH_TIMEOUT_MS = float(os.environ.get('BATCH_TIMEOUT_MS', 10))
+# Batch sizes the model is prepared for at load time (powers of two up to BATCH_MAX_SIZE)
+BATCH_BUCKETS = sorted({min(2 ** i, BATCH_MAX_SIZE) for i in range(BATCH_MAX_SIZE.bit_length() + 1)})
+
+# Split the CPUs between workers so their inference threads don't oversubscribe
+INFERENCE_THREADS = max(1, (os.cpu_count() or 1) // SERVER_WORKERS)
+tf.config.threading.set_intra_op_parallelism_threads(INFERENCE_THREADS)
 
 # Load disease information
 with open('disease_info.json', 'r') as f:
@@ -29,25 +55,137 @@ print("📥 Loading model from Cloud Storage...")
 storage_client = storage.Client()
 bucket = storage_client.bucket(BUCKET_NAME)
 
-# Download model files
-local_model_path = '/tmp/model'
-os.makedirs(local_model_path, exist_ok=True)
+# Local directory for downloaded model artifacts
+local_artifacts_path = os.path.join('/tmp', MODEL_PATH)
+os.makedirs(local_artifacts_path, exist_ok=True)
+
+def load_tflite_interpreters(model_file, use_gpu=False):
+    """
+    Download a TFLite model and prepare one interpreter per batch bucket,
+    returning None if the model is unpublished or fails to load
+    """
+    tflite_model_path = os.path.join(local_artifacts_path, model_file)
+    try:
+        bucket.blob(f"{MODEL_PATH}/{model_file}").download_to_filename(tflite_model_path)
+    except NotFound:
+        return None
+    try:
+        with open(tflite_model_path, 'rb') as f:
+            model_content = f.read()
+        
+        # Each interpreter is resized and allocated once here, so delegates
+        # never have to re-prepare on the request path
+        tflite_interpreters = {}
+        for size in BATCH_BUCKETS:
+            delegates = [tf.lite.experimental.load_delegate(TFLITE_GPU_DELEGATE)] if use_gpu else None
+            tflite_interpreter = tf.lite.Interpreter(
+                model_content=model_content,
+                experimental_delegates=delegates,
+                num_threads=INFERENCE_THREADS
+            )
+            input_index = tflite_interpreter.get_input_details()[0]['index']
+            tflite_interpreter.resize_tensor_input(input_index, (size, 224, 224, 3))
+            tflite_interpreter.allocate_tensors()
+            tflite_interpreters[size] = (
+                tflite_interpreter,
+                tflite_interpreter.get_input_details()[0],
+                tflite_interpreter.get_output_details()[0]
+            )
+        print(f"✅ TFLite model {model_file} loaded successfully (batch sizes {BATCH_BUCKETS})")
+        return tflite_interpreters
+    except Exception as e:
+        print(f"⚠️  TFLite model {model_file} loading failed: {e}")
+        return None
+
+def download_saved_model():
+    """Download the SavedModel, returning the local directory it was written to"""
+    try:
+        # Fast path: the whole SavedModel as one archive, fetched in a single GET
+        local_model_path = '/tmp/model'
+        os.makedirs(local_model_path, exist_ok=True)
+        local_archive = '/tmp/model.tar.gz'
+        bucket.blob(f"{MODEL_PATH}/{MODEL_ARCHIVE}").download_to_filename(local_archive)
+        with tarfile.open(local_archive) as archive:
+            archive.extractall(local_model_path, filter='data')
+        os.remove(local_archive)
+        return local_model_path
+    except NotFound:
+        # Fallback: download the SavedModel file by file (TFLite variants aren't part of it)
+        print("ℹ️  No model archive found, downloading files individually")
+        blobs = bucket.list_blobs(prefix=MODEL_PATH)
+        for blob in blobs:
+            if not blob.name.endswith(('/', '.tflite')):
+                local_file = os.path.join('/tmp', blob.name)
+                os.makedirs(os.path.dirname(local_file), exist_ok=True)
+                blob.download_to_filename(local_file)
+        return local_artifacts_path
 
-blobs = bucket.list_blobs(prefix=MODEL_PATH)
-for blob in blobs:
-    if not blob.name.endswith('/'):
-        local_file = os.path.join('/tmp', blob.name)
-        os.makedirs(os.path.dirname(local_file), exist_ok=True)
-        blob.download_to_filename(local_file)
+# Model input contract: every published model (SavedModel and TFLite) takes RGB
+# scaled to [0, 1] as float32, or its uint8 quantization for INT8 models;
+# run_inference maps the uint8 pixel batch into that domain
 
-# Load TensorFlow model
-try:
-    model = tf.keras.models.load_model(local_model_path)
-    print("✅ Model loaded successfully")
-except Exception as e:
-    print(f"⚠️  Model loading failed: {e}")
-    print("Using mock predictions as fallback")
-    model = None
+# FP16 + GPU delegate on GPU-backed tiers, INT8 on CPU
+# (XNNPACK is applied by the default op resolver). The GPU and delegate are
+# probed first so only the variant that will actually be loaded is downloaded
+interpreters = None
+gpu_available = False
+if tf.config.list_physical_devices('GPU'):
+    try:
+        tf.lite.experimental.load_delegate(TFLITE_GPU_DELEGATE)
+        gpu_available = True
+    except Exception as e:
+        print(f"⚠️  GPU delegate unavailable, serving the INT8 model on CPU: {e}")
+if gpu_available:
+    interpreters = load_tflite_interpreters(TFLITE_FP16_MODEL, use_gpu=True)
+if interpreters is None:
+    interpreters = load_tflite_interpreters(TFLITE_INT8_MODEL)
+
+# The SavedModel is only fetched and loaded when no TFLite model is usable
+model = None
+infer = None
+if interpreters is None:
+    try:
+        model = tf.keras.models.load_model(download_saved_model())
+        print("✅ Model loaded successfully")
+    except Exception as e:
+        print(f"⚠️  Model loading failed: {e}")
+        model = None
+
+def build_infer(jit_compile):
+    """Wrap the model in a concrete tf.function (skips Keras predict() dispatch)"""
+    @tf.function(input_signature=[tf.TensorSpec((None, 224, 224, 3), tf.uint8)], jit_compile=jit_compile)
+    def infer(x):
+        # Scale uint8 pixels to [0, 1] inside the graph, where it fuses into the first op
+        return model(tf.cast(x, tf.float32) / 255.0, training=False)
+    
+    # Trace (and for XLA, compile) every batch bucket now rather than on the request path
+    for size in BATCH_BUCKETS:
+        infer(tf.zeros((size, 224, 224, 3), tf.uint8))
+    return infer
+
+# Errors XLA raises for graphs it can't compile (unsupported ops or shapes);
+# anything else (OOM, transient runtime failures) is not a reason to leave XLA
+XLA_COMPILE_ERRORS = (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError)
+
+# XLA-compiled on CPU; XLA specializes per shape, so every batch bucket is
+# compiled at cold start instead of on the first request of that size
+xla_enabled = False
+if model is not None:
+    try:
+        infer = build_infer(jit_compile=True)
+        xla_enabled = True
+        print(f"✅ XLA inference function compiled (batch sizes {BATCH_BUCKETS})")
+    except Exception as e:
+        print(f"⚠️  XLA compilation failed, using the non-XLA graph: {e}")
+        try:
+            infer = build_infer(jit_compile=False)
+        except Exception as e:
+            print(f"⚠️  Model warm-up failed: {e}")
+            model = None
+
+model_ready = interpreters is not None or model is not None
+if not model_ready:
+    print("⚠️  No model available, /predict will return 503")
 
 # Load class names
 try:
@@ -59,38 +197,178 @@ except:
         "Apple___Apple_scab", "Grape___Black_rot"
     ]
 
+# Fallback information for classes missing from disease_info.json
+DEFAULT_DISEASE_INFO = {
+    "severity": "Medium",
+    "symptoms": [
+        "Leaf discoloration or spots",
+        "Wilting or drooping leaves",
+        "Stunted growth",
+        "Unusual leaf patterns"
+    ],
+    "treatment": [
+        "Remove affected plant parts",
+        "Apply appropriate fungicide or pesticide",
+        "Improve air circulation around plants",
+        "Ensure proper watering schedule"
+    ],
+    "prevention": [
+        "Use disease-resistant varieties",
+        "Practice crop rotation",
+        "Maintain proper plant spacing",
+        "Monitor plants regularly for early detection"
+    ]
+}
+
+def build_response_template(disease_class):
+    """Build the prediction response (minus confidence) for a class name"""
+    # Clean up disease name
+    disease_name = disease_class.replace('___', ' - ').replace('_', ' ')
+    
+    # Get disease information
+    disease_key = disease_class.split('___')[1] if '___' in disease_class else disease_class
+    disease_info = DISEASE_INFO.get(disease_key, {"name": disease_name, **DEFAULT_DISEASE_INFO})
+    
+    return {
+        "disease": disease_info.get("name", disease_name),
+        "severity": disease_info.get("severity", "Medium"),
+        "symptoms": disease_info.get("symptoms", []),
+        "treatment": disease_info.get("treatment", []),
+        "prevention": disease_info.get("prevention", [])
+    }
+
+# Response templates indexed by model class index
+RESPONSE_TEMPLATES = [build_response_template(disease_class) for disease_class in class_names]
+UNKNOWN_TEMPLATE = build_response_template("Unknown")
+
 def preprocess_image(image_data):
     """Preprocess image for model prediction"""
     # Decode base64 image
-    image_bytes = base64.b64decode(image_data)
-    image = Image.open(io.BytesIO(image_bytes))
+    image = Image.open(io.BytesIO(base64.b64decode(image_data)))
     
-    # Resize to model input size
-    image = image.resize((224, 224))
+    # Let libjpeg decode straight to RGB at the smallest scale >= 224x224 (JPEG only)
+    image.draft('RGB', (224, 224))
     
-    # Convert to RGB
+    # Convert to RGB (skipped when the decoder already produced RGB)
     if image.mode != 'RGB':
         image = image.convert('RGB')
     
-    # Convert to numpy array and normalize
-    img_array = np.array(image) / 255.0
+    # Resize to model input size on the decoded uint8 buffer; scaling to the
+    # model's input domain happens once per batch in run_inference
+    return cv2.resize(np.asarray(image), (224, 224), interpolation=cv2.INTER_AREA)
+
+def run_inference(batch):
+    """Run the loaded model on a uint8 RGB batch (of a bucket size), returning probabilities"""
+    global infer, xla_enabled
+    
+    if interpreters is None:
+        try:
+            return infer(tf.constant(batch)).numpy()
+        except XLA_COMPILE_ERRORS as e:
+            if not xla_enabled:
+                raise
+            # XLA couldn't compile this graph; switch to the (warmed) plain graph for this and later batches
+            print(f"⚠️  XLA inference failed, using the non-XLA graph: {e}")
+            infer = build_infer(jit_compile=False)
+            xla_enabled = False
+            return infer(tf.constant(batch)).numpy()
+    
+    # Only the batch worker thread calls this, so the interpreters are never shared
+    interpreter, input_details, output_details = interpreters[len(batch)]
+    
+    if input_details['dtype'] == np.uint8:
+        # INT8 model: pixels / 255 quantized with (1/255, 0) are the pixels themselves,
+        # so they go in as-is; other input quantizations are mapped straight from uint8
+        input_scale, input_zero_point = input_details['quantization']
+        if not (np.isclose(input_scale, 1.0 / 255.0) and input_zero_point == 0):
+            batch = np.clip(np.round(batch * np.float32(1.0 / 255.0 / input_scale) + input_zero_point), 0, 255).astype(np.uint8)
+    else:
+        # Float model: cast + normalize in one pass
+        batch = np.multiply(batch, np.float32(1.0 / 255.0), dtype=np.float32)
+    
+    interpreter.set_tensor(input_details['index'], batch)
+    interpreter.invoke()
+    output = interpreter.get_tensor(output_details['index'])
     
-    # Add batch dimension
-    img_array = np.expand_dims(img_array, axis=0)
+    # Dequantize the output back to probabilities
+    if output_details['dtype'] == np.uint8:
+        output_scale, output_zero_point = output_details['quantization']
+        output = (output.astype(np.float32) - output_zero_point) * output_scale
+    return output
+
+batch_queue = queue.Queue()
+
+# Requests currently being preprocessed or waiting for a prediction
+active_requests = 0
+active_requests_lock = threading.Lock()
+
+def batch_worker():
+    """Coalesce queued requests into a single model call and fan the results back out"""
+    while True:
+        items = [batch_queue.get()]
+        deadline = time.monotonic() + BATCH_TIMEOUT_MS / 1000.0
+        # Stop early once every active request is already part of this batch
+        while len(items) < min(BATCH_MAX_SIZE, active_requests):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        try:
+            # Zero-pad up to the next prepared batch size and drop the padding rows after
+            batch_size = next(size for size in BATCH_BUCKETS if size >= len(items))
+            batch = np.zeros((batch_size, 224, 224, 3), dtype=np.uint8)
+            for row, (image, _, _) in enumerate(items):
+                batch[row] = image
+            predictions = run_inference(batch)[:len(items)]
+            
+            # Reduce the whole batch at once, then fan out plain Python values
+            class_indices = np.argmax(predictions, axis=1)
+            confidences = predictions[np.arange(len(items)), class_indices]
+            for (_, _, result), class_idx, confidence in zip(items, class_indices.tolist(), confidences.tolist()):
+                result['class_idx'] = class_idx
+                result['confidence'] = confidence
+        except Exception as e:
+            for _, _, result in items:
+                result['error'] = e
+        finally:
+            for _, done, _ in items:
+                done.set()
+
+def predict_image(image):
+    """Queue a preprocessed image for batched inference and wait for its prediction"""
+    done = threading.Event()
+    result = {}
+    batch_queue.put((image, done, result))
+    done.wait()
     
-    return img_array
+    if 'error' in result:
+        raise result['error']
+    return result['class_idx'], result['confidence']
+
+if model_ready:
+    threading.Thread(target=batch_worker, daemon=True).start()
+
+def json_response(payload, status, headers):
+    """Serialize a response body with orjson (C serializer, faster than jsonify)"""
+    return app.response_class(orjson.dumps(payload), status=status, headers=headers, mimetype='application/json')
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'model_loaded': model is not None
+        'model_loaded': model_ready
     }), 200
 
 @app.route('/predict', methods=['POST', 'OPTIONS'])
 def predict_disease():
     """Predict crop disease from image"""
+    global active_requests
+    
     # Handle CORS
     if request.method == 'OPTIONS':
         headers = {
@@ -106,69 +384,35 @@ def predict_disease():
     try:
         request_json = request.get_json()
         if not request_json or 'image' not in request_json:
-            return jsonify({'error': 'No image provided'}), 400, headers
+            return json_response({'error': 'No image provided'}, 400, headers)
         
-        # Preprocess image
-        processed_image = preprocess_image(request_json['image'])
+        # Fail fast without preprocessing when no model could be loaded
+        if not model_ready:
+            return json_response({'error': 'Model unavailable'}, 503, headers)
         
-        # Make prediction
-        if model is not None:
-            # Real model prediction
-            predictions = model.predict(processed_image)
-            class_idx = np.argmax(predictions[0])
-            confidence = float(predictions[0][class_idx])
+        with active_requests_lock:
+            active_requests += 1
+        try:
+            # Preprocess image (threads decode concurrently; Pillow and OpenCV release the GIL)
+            processed_image = preprocess_image(request_json['image'])
             
-            # Get disease name
-            disease_class = class_names[class_idx] if class_idx < len(class_names) else "Unknown"
-        else:
-            # Fallback to mock prediction
-            import random
-            disease_class = random.choice(class_names)
-            confidence = random.uniform(0.75, 0.95)
+            # Make prediction
+            class_idx, confidence = predict_image(processed_image)
+        finally:
+            with active_requests_lock:
+                active_requests -= 1
         
-        # Clean up disease name
-        disease_name = disease_class.replace('___', ' - ').replace('_', ' ')
+        # Get disease response template
+        template = RESPONSE_TEMPLATES[class_idx] if class_idx < len(RESPONSE_TEMPLATES) else UNKNOWN_TEMPLATE
         
-        # Get disease information
-        disease_key = disease_class.split('___')[1] if '___' in disease_class else disease_class
-        disease_info = DISEASE_INFO.get(disease_key, {
-            "name": disease_name,
-            "severity": "Medium",
-            "symptoms": [
-                "Leaf discoloration or spots",
-                "Wilting or drooping leaves",
-                "Stunted growth",
-                "Unusual leaf patterns"
-            ],
-            "treatment": [
-                "Remove affected plant parts",
-                "Apply appropriate fungicide or pesticide",
-                "Improve air circulation around plants",
-                "Ensure proper watering schedule"
-            ],
-            "prevention": [
-                "Use disease-resistant varieties",
-                "Practice crop rotation",
-                "Maintain proper plant spacing",
-                "Monitor plants regularly for early detection"
-            ]
-        })
-        
-        # Prepare response
-        result = {
-            "disease": disease_info.get("name", disease_name),
-            "confidence": round(confidence * 100, 2),
-            "severity": disease_info.get("severity", "Medium"),
-            "symptoms": disease_info.get("symptoms", []),
-            "treatment": disease_info.get("treatment", []),
-            "prevention": disease_info.get("prevention", [])
-        }
+        # Prepare response from the precomputed per-class template
+        result = {**template, "confidence": round(confidence * 100, 2)}
         
-        return jsonify(result), 200, headers
+        return json_response(result, 200, headers)
         
     except Exception as e:
         print(f"Error: {str(e)}")
-        return jsonify({'error': str(e)}), 500, headers
+        return json_response({'error': str(e)}, 500, headers)
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 8080))
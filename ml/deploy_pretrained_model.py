@@ -7,11 +7,16 @@ import tensorflow as tf
 import tensorflow_hub as hub
 import json
 import os
+import shutil
 from google.cloud import storage
 
 # Pre-trained model from TensorFlow Hub
 MODEL_URL = "https://tfhub.dev/google/aiy/vision/classifier/plants_V1/1"
 
+# Calibration images for post-training INT8 quantization
+CALIBRATION_DATA_PATTERN = "gs://kenya-agri-farmwise-ml/datasets/plantvillage/train/*/*.jpg"
+NUM_CALIBRATION_IMAGES = 100
+
 print("📥 Downloading pre-trained plant disease model from TensorFlow Hub...")
 
 # Create model
@@ -26,6 +31,10 @@ model_path = 'pretrained_plant_model'
 model.save(model_path, save_format='tf')
 print(f"✅ Model saved to {model_path}")
 
+# Package the SavedModel as a single archive so the API can fetch it in one GET
+archive_path = shutil.make_archive('model', 'gztar', model_path)
+print(f"✅ Model archived to {archive_path}")
+
 # Upload to Cloud Storage
 print("\n☁️  Uploading to Cloud Storage...")
 storage_client = storage.Client()
@@ -40,6 +49,10 @@ for root, dirs, files in os.walk(model_path):
         blob.upload_from_filename(local_path)
         print(f"  ✅ Uploaded {file}")
 
+archive_blob = bucket.blob(f"models/plant-disease-detector/{os.path.basename(archive_path)}")
+archive_blob.upload_from_filename(archive_path)
+print(f"  ✅ Uploaded {os.path.basename(archive_path)}")
+
 # Save class names
 class_names = [
     "Apple___Apple_scab", "Apple___Black_rot", "Apple___Cedar_apple_rust", "Apple___healthy",
@@ -60,5 +73,72 @@ class_names_blob = bucket.blob("models/plant-disease-detector/class_names.json")
 class_names_blob.upload_from_string(json.dumps(class_names))
 print("✅ Class names uploaded")
 
+# Post-training INT8 quantization for CPU serving (optional: needs calibration images)
+print("\n⚙️  Quantizing model to INT8 TFLite...")
+tflite_path = 'model_int8.tflite'
+tflite_blob = bucket.blob(f"models/plant-disease-detector/{tflite_path}")
+calibration_files = tf.io.gfile.glob(CALIBRATION_DATA_PATTERN)
+
+def representative_dataset():
+    """Yield calibration images preprocessed the same way as the serving API"""
+    image_files = tf.random.shuffle(calibration_files)[:NUM_CALIBRATION_IMAGES]
+    for image_file in image_files:
+        img = tf.io.read_file(image_file)
+        img = tf.image.decode_jpeg(img, channels=3)
+        img = tf.image.resize(img, (224, 224), method='area')
+        img = tf.cast(img, tf.float32) / 255.0
+        yield [tf.expand_dims(img, 0)]
+
+tflite_model = None
+if not calibration_files:
+    print(f"⚠️  No calibration images found at {CALIBRATION_DATA_PATTERN}, skipping INT8 model")
+    print("   Run prepare_dataset.py first to enable INT8 quantization")
+else:
+    try:
+        converter = tf.lite.TFLiteConverter.from_saved_model(model_path)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.uint8
+        converter.inference_output_type = tf.uint8
+        tflite_model = converter.convert()
+    except Exception as e:
+        print(f"⚠️  INT8 conversion failed, skipping INT8 model: {e}")
+
+if tflite_model is not None:
+    with open(tflite_path, 'wb') as f:
+        f.write(tflite_model)
+    print(f"✅ INT8 model saved to {tflite_path} ({len(tflite_model) / 1e6:.1f} MB)")
+    
+    tflite_blob.upload_from_filename(tflite_path)
+    print(f"  ✅ Uploaded {tflite_path}")
+elif tflite_blob.exists():
+    # Don't leave a stale INT8 model around for the API to serve instead of this one
+    tflite_blob.delete()
+    print(f"  🗑️  Removed stale {tflite_path}")
+
+# FP16 variant for GPU-backed serving tiers (optional)
+print("\n⚙️  Converting model to FP16 TFLite...")
+tflite_fp16_path = 'model_fp16.tflite'
+tflite_fp16_blob = bucket.blob(f"models/plant-disease-detector/{tflite_fp16_path}")
+try:
+    converter = tf.lite.TFLiteConverter.from_saved_model(model_path)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+    tflite_fp16_model = converter.convert()
+    
+    with open(tflite_fp16_path, 'wb') as f:
+        f.write(tflite_fp16_model)
+    print(f"✅ FP16 model saved to {tflite_fp16_path} ({len(tflite_fp16_model) / 1e6:.1f} MB)")
+    
+    tflite_fp16_blob.upload_from_filename(tflite_fp16_path)
+    print(f"  ✅ Uploaded {tflite_fp16_path}")
+except Exception as e:
+    print(f"⚠️  FP16 conversion failed, skipping FP16 model: {e}")
+    if tflite_fp16_blob.exists():
+        # GPU instances prefer FP16, so a stale one would keep serving the previous model
+        tflite_fp16_blob.delete()
+        print(f"  🗑️  Removed stale {tflite_fp16_path}")
+
 print("\n🎉 Pre-trained model deployed successfully!")
 print(f"Model location: gs://kenya-agri-farmwise-ml/models/plant-disease-detector/")
@@ -4,14 +4,23 @@ This script downloads the dataset from Kaggle and uploads to Cloud Storage
 """
 
 import os
+import math
+import random
 import shutil
+import tensorflow as tf
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 import kagglehub
+from class_names import CLASS_NAMES
 
 # Configuration
 BUCKET_NAME = "kenya-agri-farmwise-ml"
 KAGGLE_DATASET = "abdallahalidev/plantvillage-dataset"
 GCS_PREFIX = "datasets/plantvillage"
+UPLOAD_MAX_WORKERS = 64
+UPLOAD_BATCH_SIZE = 1000
+TFRECORD_PREFIX = f"{GCS_PREFIX}/tfrecords"
+TFRECORD_SHARD_BYTES = 256 * 1024 * 1024
 
 def download_from_kaggle():
     """Download PlantVillage dataset from Kaggle using kagglehub"""
@@ -24,15 +33,8 @@ def download_from_kaggle():
     print(f"✅ Dataset downloaded to: {path}")
     return path
 
-def upload_to_gcs(dataset_path):
-    """Upload dataset to Google Cloud Storage"""
-    print(f"\n☁️  Uploading dataset to gs://{BUCKET_NAME}/{GCS_PREFIX}/...")
-    
-    # Initialize storage client
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
-    
-    # Find train and val directories in the downloaded dataset
+def find_splits(dataset_path):
+    """Locate the train/val directories in the downloaded dataset"""
     # The structure might vary, so we'll search for them
     train_dir = None
     val_dir = None
@@ -48,7 +50,6 @@ def upload_to_gcs(dataset_path):
         if 'validation' in dirs and val_dir is None:
             val_dir = os.path.join(root, 'validation')
     
-    # Upload train and val directories
     splits = []
     if train_dir:
         splits.append(('train', train_dir))
@@ -59,33 +60,101 @@ def upload_to_gcs(dataset_path):
         print("⚠️  Warning: No train/val directories found. Uploading entire dataset...")
         splits = [('all', dataset_path)]
     
+    return splits
+
+def upload_to_gcs(dataset_path):
+    """Upload dataset to Google Cloud Storage"""
+    print(f"\n☁️  Uploading dataset to gs://{BUCKET_NAME}/{GCS_PREFIX}/...")
+    
+    # Initialize storage client
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(BUCKET_NAME)
+    
+    # Upload train and val directories
+    splits = find_splits(dataset_path)
+    
     for split_name, split_dir in splits:
         print(f"\n📤 Uploading {split_name} split from {split_dir}...")
         
-        file_count = 0
-        # Walk through directory
+        # Collect image paths relative to the split directory (these become blob names)
+        filenames = []
         for root, dirs, files in os.walk(split_dir):
             for file in files:
                 if file.endswith(('.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG')):
-                    local_path = os.path.join(root, file)
-                    
-                    # Create GCS path
-                    relative_path = os.path.relpath(local_path, split_dir)
-                    gcs_path = f"{GCS_PREFIX}/{split_name}/{relative_path}".replace('\\', '/')
-                    
-                    # Upload file
-                    blob = bucket.blob(gcs_path)
-                    blob.upload_from_filename(local_path)
-                    
-                    file_count += 1
-                    # Print progress every 100 files
-                    if file_count % 100 == 0:
-                        print(f"  Uploaded {file_count} files...")
+                    relative_path = os.path.relpath(os.path.join(root, file), split_dir)
+                    filenames.append(relative_path.replace('\\', '/'))
         
+        # Upload in parallel, one batch at a time so progress can be reported
+        file_count = 0
+        failed_count = 0
+        for start in range(0, len(filenames), UPLOAD_BATCH_SIZE):
+            batch = filenames[start:start + UPLOAD_BATCH_SIZE]
+            results = transfer_manager.upload_many_from_filenames(
+                bucket,
+                batch,
+                source_directory=split_dir,
+                blob_name_prefix=f"{GCS_PREFIX}/{split_name}/",
+                max_workers=UPLOAD_MAX_WORKERS,
+                worker_type=transfer_manager.THREAD
+            )
+            
+            for filename, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    failed_count += 1
+                    print(f"  ⚠️  Failed to upload {filename}: {result}")
+            
+            file_count += len(batch)
+            print(f"  Uploaded {file_count}/{len(filenames)} files...")
+        
+        if failed_count:
+            print(f"⚠️  {failed_count} {split_name} files failed to upload")
         print(f"✅ {split_name} split uploaded ({file_count} files)")
     
     print(f"\n🎉 Dataset uploaded to gs://{BUCKET_NAME}/{GCS_PREFIX}/")
 
+def write_tfrecords(dataset_path):
+    """Pack each split into ~256 MB TFRecord shards of (JPEG bytes, class index)"""
+    print(f"\n📦 Writing TFRecord shards to gs://{BUCKET_NAME}/{TFRECORD_PREFIX}/...")
+    class_to_index = {name: idx for idx, name in enumerate(CLASS_NAMES)}
+    
+    for split_name, split_dir in find_splits(dataset_path):
+        # Collect (path, label) pairs; the shard count depends on the total size
+        examples = []
+        total_bytes = 0
+        for root, dirs, files in os.walk(split_dir):
+            class_name = os.path.basename(root)
+            if class_name not in class_to_index:
+                continue
+            for file in files:
+                if file.lower().endswith(('.jpg', '.jpeg')):
+                    local_path = os.path.join(root, file)
+                    examples.append((local_path, class_to_index[class_name]))
+                    total_bytes += os.path.getsize(local_path)
+        
+        if not examples:
+            print(f"⚠️  No labelled images found for {split_name}, skipping")
+            continue
+        
+        # Shuffle once so every shard holds a mix of classes
+        random.shuffle(examples)
+        num_shards = max(1, math.ceil(total_bytes / TFRECORD_SHARD_BYTES))
+        print(f"\n📤 Writing {split_name} split ({len(examples)} images, {num_shards} shards)...")
+        
+        for shard in range(num_shards):
+            shard_path = f"gs://{BUCKET_NAME}/{TFRECORD_PREFIX}/{split_name}-{shard:05d}-of-{num_shards:05d}.tfrecord"
+            with tf.io.TFRecordWriter(shard_path) as writer:
+                for local_path, label in examples[shard::num_shards]:
+                    with open(local_path, 'rb') as f:
+                        image_bytes = f.read()
+                    example = tf.train.Example(features=tf.train.Features(feature={
+                        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_bytes])),
+                        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label]))
+                    }))
+                    writer.write(example.SerializeToString())
+            print(f"  Wrote shard {shard + 1}/{num_shards}")
+        
+        print(f"✅ {split_name} TFRecords written")
+
 def verify_upload():
     """Verify dataset was uploaded correctly"""
     print("\n🔍 Verifying upload...")
@@ -108,29 +177,26 @@ def create_dataset_csv():
     storage_client = storage.Client()
     bucket = storage_client.bucket(BUCKET_NAME)
     
-    csv_lines = []
-    
-    # List all training images
+    # List all training images (only names are needed, so skip the other metadata)
     prefix = f"{GCS_PREFIX}/train/"
-    blobs = bucket.list_blobs(prefix=prefix)
-    
-    for blob in blobs:
-        if blob.name.endswith(('.jpg', '.jpeg', '.png')):
-            # Extract class name from path
-            # Format: datasets/plantvillage/train/ClassName/image.jpg
-            parts = blob.name.split('/')
-            if len(parts) >= 4:
-                class_name = parts[-2]
-                gcs_uri = f"gs://{BUCKET_NAME}/{blob.name}"
-                csv_lines.append(f"{gcs_uri},{class_name}")
-    
-    # Save CSV
+    blobs = bucket.list_blobs(prefix=prefix, fields='items(name),nextPageToken')
+    
+    # Stream rows straight to the CSV
     csv_path = "dataset_import.csv"
+    image_count = 0
     with open(csv_path, 'w') as f:
-        f.write('\n'.join(csv_lines))
+        for blob in blobs:
+            if blob.name.endswith(('.jpg', '.jpeg', '.png')):
+                # Extract class name from path
+                # Format: datasets/plantvillage/train/ClassName/image.jpg
+                parts = blob.name.split('/')
+                if len(parts) >= 4:
+                    class_name = parts[-2]
+                    f.write(f"gs://{BUCKET_NAME}/{blob.name},{class_name}\n")
+                    image_count += 1
     
     print(f"✅ CSV created: {csv_path}")
-    print(f"   Total images: {len(csv_lines)}")
+    print(f"   Total images: {image_count}")
     
     # Upload CSV to GCS
     blob = bucket.blob(f"{GCS_PREFIX}/dataset_import.csv")
@@ -163,13 +229,16 @@ if __name__ == "__main__":
     # Step 2: Upload to GCS
     upload_to_gcs(dataset_path)
     
-    # Step 3: Verify upload
+    # Step 3: Write TFRecord shards for training
+    write_tfrecords(dataset_path)
+    
+    # Step 4: Verify upload
     verify_upload()
     
-    # Step 4: Create dataset CSV
+    # Step 5: Create dataset CSV
     create_dataset_csv()
     
-    # Step 5: Cleanup (optional)
+    # Step 6: Cleanup (optional)
     cleanup_choice = input("\n🗑️  Clean up local files? (y/n): ")
     if cleanup_choice.lower() == 'y':
         cleanup_local(dataset_path)
@@ -4,13 +4,16 @@ Trains on PlantVillage dataset from Cloud Storage
 """
 
 import os
+import math
 import argparse
 import json
 import tensorflow as tf
 from google.cloud import storage
-from tensorflow.keras.applications import EfficientNetB4
+from tensorflow.keras.applications import MobileNetV3Large
 from tensorflow.keras import layers, models, callbacks
+import tensorflow_model_optimization as tfmot
 import numpy as np
+from class_names import CLASS_NAMES
 
 # Configuration from environment variables (set by Vertex AI)
 PROJECT_ID = os.environ.get('CLOUD_ML_PROJECT_ID', 'kenya-agri-farmwise')
@@ -18,86 +21,92 @@ REGION = os.environ.get('CLOUD_ML_REGION', 'us-central1')
 BUCKET_NAME = os.environ.get('GCS_BUCKET', 'kenya-agri-farmwise-ml')
 MODEL_DIR = os.environ.get('AIP_MODEL_DIR', '/tmp/model')
 CHECKPOINT_DIR = os.environ.get('AIP_CHECKPOINT_DIR', '/tmp/checkpoints')
+# Local disk for the decoded dataset snapshot (reused by every epoch after the first)
+SNAPSHOT_DIR = os.environ.get('DATASET_SNAPSHOT_DIR', '/tmp/data')
+# The snapshot is sharded into contiguous blocks of records; each epoch reads the
+# blocks back in a fresh global order, a few at a time
+SNAPSHOT_SHARD_SIZE = 256
+SNAPSHOT_READ_CYCLE = 8
+# Upper bound on the shard count, so the reader's shuffle permutes every block
+SNAPSHOT_MAX_SHARDS = 1024
 
-# Dataset paths in Cloud Storage
-TRAIN_DATA_PATH = f"gs://{BUCKET_NAME}/datasets/plantvillage/train"
-VAL_DATA_PATH = f"gs://{BUCKET_NAME}/datasets/plantvillage/val"
+# Dataset TFRecord shards in Cloud Storage (written by prepare_dataset.py)
+TRAIN_DATA_PATH = f"gs://{BUCKET_NAME}/datasets/plantvillage/tfrecords/train"
+VAL_DATA_PATH = f"gs://{BUCKET_NAME}/datasets/plantvillage/tfrecords/val"
 
 # Model parameters
 IMG_SIZE = (224, 224)
-BATCH_SIZE = 32
+BATCH_SIZE = 64
 EPOCHS = 50
 LEARNING_RATE = 0.001
 
-# PlantVillage disease classes
-CLASS_NAMES = [
-    "Apple___Apple_scab",
-    "Apple___Black_rot",
-    "Apple___Cedar_apple_rust",
-    "Apple___healthy",
-    "Blueberry___healthy",
-    "Cherry_(including_sour)___Powdery_mildew",
-    "Cherry_(including_sour)___healthy",
-    "Corn_(maize)___Cercospora_leaf_spot Gray_leaf_spot",
-    "Corn_(maize)___Common_rust_",
-    "Corn_(maize)___Northern_Leaf_Blight",
-    "Corn_(maize)___healthy",
-    "Grape___Black_rot",
-    "Grape___Esca_(Black_Measles)",
-    "Grape___Leaf_blight_(Isariopsis_Leaf_Spot)",
-    "Grape___healthy",
-    "Orange___Haunglongbing_(Citrus_greening)",
-    "Peach___Bacterial_spot",
-    "Peach___healthy",
-    "Pepper,_bell___Bacterial_spot",
-    "Pepper,_bell___healthy",
-    "Potato___Early_blight",
-    "Potato___Late_blight",
-    "Potato___healthy",
-    "Raspberry___healthy",
-    "Soybean___healthy",
-    "Squash___Powdery_mildew",
-    "Strawberry___Leaf_scorch",
-    "Strawberry___healthy",
-    "Tomato___Bacterial_spot",
-    "Tomato___Early_blight",
-    "Tomato___Late_blight",
-    "Tomato___Leaf_Mold",
-    "Tomato___Septoria_leaf_spot",
-    "Tomato___Spider_mites Two-spotted_spider_mite",
-    "Tomato___Target_Spot",
-    "Tomato___Tomato_Yellow_Leaf_Curl_Virus",
-    "Tomato___Tomato_mosaic_virus",
-    "Tomato___healthy"
-]
+# Model optimization for deployment (pruning in Phase 2, QAT in Phase 3)
+PRUNING_SPARSITY = 0.5
+# Fraction of the Phase 2 epochs over which sparsity ramps up to PRUNING_SPARSITY
+PRUNING_RAMP_FRACTION = 0.5
+QAT_EPOCHS = 5
+OPTIMIZABLE_LAYERS = (layers.Conv2D, layers.DepthwiseConv2D, layers.Dense)
+
+# libjpeg IDCT variant used when decoding ('' is the accurate libjpeg default, matching
+# serving; set 'INTEGER_FAST' to benchmark the faster, lower-precision IDCT)
+JPEG_DCT_METHOD = os.environ.get('JPEG_DCT_METHOD', '')
 
 NUM_CLASSES = len(CLASS_NAMES)
 
 
+def decode_and_resize_jpeg(image_bytes):
+    """
+    Decode a JPEG at the smallest libjpeg scale (1/1, 1/2, 1/4, 1/8) that still
+    covers IMG_SIZE, then resize to IMG_SIZE
+    """
+    shape = tf.image.extract_jpeg_shape(image_bytes)
+    short_side = tf.minimum(shape[0], shape[1])
+    target = min(IMG_SIZE)
+    
+    # Number of downscale ratios that keep the short side >= target picks the branch
+    ratios = [1, 2, 4, 8]
+    branch = tf.reduce_sum(tf.cast(short_side // ratios[1:] >= target, tf.int32))
+    
+    def decode(ratio):
+        return lambda: tf.image.decode_jpeg(
+            image_bytes, channels=3, ratio=ratio, dct_method=JPEG_DCT_METHOD
+        )
+    
+    img = tf.switch_case(branch, [decode(ratio) for ratio in ratios])
+    return tf.image.resize(img, IMG_SIZE)
+
+
 def create_dataset_from_gcs(data_path, is_training=True):
     """
-    Create tf.data.Dataset from images in Cloud Storage
+    Create tf.data.Dataset from TFRecord shards in Cloud Storage
     """
-    # List all image files in GCS
-    gcs_pattern = f"{data_path}/*/*.jpg"
-    
-    # Create dataset from file patterns
-    list_ds = tf.data.Dataset.list_files(gcs_pattern, shuffle=is_training)
-    
-    def parse_image(file_path):
-        # Read image
-        img = tf.io.read_file(file_path)
-        img = tf.image.decode_jpeg(img, channels=3)
-        img = tf.image.resize(img, IMG_SIZE)
-        img = img / 255.0  # Normalize
+    # List all shards in GCS (format: gs://bucket/.../train-00000-of-00004.tfrecord)
+    gcs_pattern = f"{data_path}-*.tfrecord"
+    
+    # Read several shards in parallel, one sequential stream per shard
+    shard_ds = tf.data.Dataset.list_files(gcs_pattern, shuffle=is_training)
+    records_ds = shard_ds.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=16,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=not is_training
+    )
+    
+    feature_description = {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.int64)
+    }
+    
+    def parse_example(serialized):
+        example = tf.io.parse_single_example(serialized, feature_description)
         
-        # Extract label from path (format: gs://bucket/train/ClassName/image.jpg)
-        parts = tf.strings.split(file_path, '/')
-        class_name = parts[-2]
+        # Decode image
+        img = decode_and_resize_jpeg(example['image'])
+        # Keep uint8 in the pipeline; normalization happens inside the model
+        img = tf.saturate_cast(tf.round(img), tf.uint8)
         
-        # Convert class name to index
-        label = tf.where(tf.equal(CLASS_NAMES, class_name))[0][0]
-        label = tf.one_hot(label, NUM_CLASSES)
+        # Sparse integer label; the loss consumes it directly without one-hot
+        label = example['label']
         
         return img, label
     
@@ -113,12 +122,35 @@ def create_dataset_from_gcs(data_path, is_training=True):
             image = tf.image.rot90(image, k)
         return image, label
     
-    # Parse images and apply augmentation
-    dataset = list_ds.map(parse_image, num_parallel_calls=tf.data.AUTOTUNE)
+    # Parse images once and snapshot the decoded uint8 tensors to local disk;
+    # augmentation runs after the snapshot so it still varies per epoch
+    dataset = records_ds.map(parse_example, num_parallel_calls=tf.data.AUTOTUNE)
+    snapshot_path = os.path.join(
+        SNAPSHOT_DIR, f"plantvillage_{os.path.basename(data_path)}_{IMG_SIZE[0]}"
+    )
     
     if is_training:
+        # Write contiguous blocks of records to separate shards, then read the blocks
+        # in a new random order each epoch while interleaving only a few at a time,
+        # so the order of examples changes globally after epoch 1 (interleaving every
+        # shard round-robin would rebuild the epoch-1 order)
+        dataset = dataset.enumerate().snapshot(
+            snapshot_path,
+            compression='AUTO',
+            shard_func=lambda index, example: index // SNAPSHOT_SHARD_SIZE,
+            reader_func=lambda shards: shards.shuffle(SNAPSHOT_MAX_SHARDS).interleave(
+                lambda shard: shard,
+                cycle_length=SNAPSHOT_READ_CYCLE,
+                num_parallel_calls=tf.data.AUTOTUNE,
+                deterministic=False
+            )
+        )
+        dataset = dataset.map(lambda index, example: example)
         dataset = dataset.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+        # uint8 images keep this buffer at ~150 MB
         dataset = dataset.shuffle(1000)
+    else:
+        dataset = dataset.snapshot(snapshot_path, compression='AUTO')
     
     dataset = dataset.batch(BATCH_SIZE)
     dataset = dataset.prefetch(tf.data.AUTOTUNE)
@@ -128,38 +160,139 @@ def create_dataset_from_gcs(data_path, is_training=True):
 
 def create_model():
     """
-    Create EfficientNetB4 model with custom classification head
+    Create MobileNetV3Large model with custom classification head
     """
-    # Load pre-trained EfficientNetB4
-    base_model = EfficientNetB4(
+    # Inputs are uint8 [0, 255]; the base model's built-in Rescaling layer
+    # normalizes them to [-1, 1] on the accelerator. Exports are wrapped by
+    # build_serving_model to take the API's [0, 1] inputs instead
+    inputs = tf.keras.Input(shape=(*IMG_SIZE, 3))
+    
+    # Load pre-trained MobileNetV3Large (minimalistic variant quantizes well for CPU serving).
+    # Built on `inputs` so the model graph stays flat, which pruning and QAT require
+    base_model = MobileNetV3Large(
         include_top=False,
         weights='imagenet',
-        input_shape=(*IMG_SIZE, 3)
+        input_tensor=inputs,
+        minimalistic=True
     )
     
     # Freeze base model initially
     base_model.trainable = False
     
     # Build model
-    inputs = tf.keras.Input(shape=(*IMG_SIZE, 3))
-    x = base_model(inputs, training=False)
+    x = base_model.output
     x = layers.GlobalAveragePooling2D()(x)
     x = layers.BatchNormalization()(x)
     x = layers.Dropout(0.3)(x)
     x = layers.Dense(512, activation='relu')(x)
     x = layers.BatchNormalization()(x)
     x = layers.Dropout(0.3)(x)
-    outputs = layers.Dense(NUM_CLASSES, activation='softmax')(x)
+    # Keep the softmax in float32 for numerical stability under mixed precision
+    outputs = layers.Dense(NUM_CLASSES, activation='softmax', dtype='float32', name='predictions')(x)
     
     model = models.Model(inputs, outputs)
     
     return model, base_model
 
 
+def build_serving_model(model):
+    """
+    Wrap the trained model in the serving API's input contract: float32 RGB in [0, 1].
+    Training feeds raw [0, 255] pixels (normalized by the base model's Rescaling
+    layer), so the wrapper scales back up before calling the model
+    """
+    inputs = tf.keras.Input(shape=(*IMG_SIZE, 3), name='image')
+    x = layers.Rescaling(255.0)(inputs)
+    return models.Model(inputs, model(x))
+
+
+def count_records(data_path):
+    """
+    Count the examples in a split's TFRecord shards (one sequential read, no decoding)
+    """
+    shard_files = tf.io.gfile.glob(f"{data_path}-*.tfrecord")
+    records_ds = tf.data.TFRecordDataset(shard_files, num_parallel_reads=tf.data.AUTOTUNE)
+    return int(records_ds.reduce(np.int64(0), lambda count, _: count + 1))
+
+
+def dense_layer_names(model):
+    """
+    Names of the conv/dense layers left unpruned: the stem conv and the classifier,
+    which are small and accuracy-critical
+    """
+    first_conv = next(layer for layer in model.layers if isinstance(layer, layers.Conv2D))
+    return {first_conv.name, 'predictions'}
+
+
+def measure_sparsity(model):
+    """
+    Fraction of zero weights across the kernels of the pruned layers
+    """
+    keep_dense = dense_layer_names(model)
+    zeros, total = 0, 0
+    for layer in model.layers:
+        if isinstance(layer, OPTIMIZABLE_LAYERS) and layer.name not in keep_dense:
+            kernel = layer.weights[0].numpy()
+            zeros += np.count_nonzero(kernel == 0)
+            total += kernel.size
+    return zeros / total
+
+
+def apply_pruning(model, end_step):
+    """
+    Wrap the model's conv and dense layers for magnitude-based weight pruning,
+    ramping sparsity from 0 to PRUNING_SPARSITY over `end_step` training steps
+    """
+    pruning_schedule = tfmot.sparsity.keras.PolynomialDecay(
+        initial_sparsity=0.0,
+        final_sparsity=PRUNING_SPARSITY,
+        begin_step=0,
+        end_step=end_step,
+        frequency=100
+    )
+    
+    keep_dense = dense_layer_names(model)
+    
+    def prune_layer(layer):
+        if isinstance(layer, OPTIMIZABLE_LAYERS) and layer.name not in keep_dense:
+            return tfmot.sparsity.keras.prune_low_magnitude(layer, pruning_schedule=pruning_schedule)
+        return layer
+    
+    return tf.keras.models.clone_model(model, clone_function=prune_layer)
+
+
+def apply_quantization_aware_training(model):
+    """
+    Rebuild the model in float32 and insert fake-quant nodes on its conv and dense layers
+    """
+    # Fake-quant ops don't support float16, so leave mixed precision for this phase
+    tf.keras.mixed_precision.set_global_policy('float32')
+    
+    def to_float32(layer):
+        return layer.__class__.from_config({**layer.get_config(), 'dtype': 'float32'})
+    
+    float_model = tf.keras.models.clone_model(model, clone_function=to_float32)
+    float_model.set_weights(model.get_weights())
+    
+    def annotate_layer(layer):
+        if isinstance(layer, OPTIMIZABLE_LAYERS):
+            return tfmot.quantization.keras.quantize_annotate_layer(layer)
+        return layer
+    
+    annotated_model = tf.keras.models.clone_model(float_model, clone_function=annotate_layer)
+    return tfmot.quantization.keras.quantize_apply(
+        annotated_model,
+        tfmot.experimental.combine.Default8BitPrunePreserveQuantizeScheme()
+    )
+
+
 def train_model(args):
     """
     Main training function
     """
+    # Mixed precision: float16 compute on Tensor Cores, float32 variables
+    tf.keras.mixed_precision.set_global_policy('mixed_float16')
+    
     print("=" * 60)
     print("Starting Crop Disease Detection Model Training")
     print("=" * 60)
@@ -169,6 +302,8 @@ def train_model(args):
     print(f"Number of Classes: {NUM_CLASSES}")
     print(f"Image Size: {IMG_SIZE}")
     print(f"Batch Size: {BATCH_SIZE}")
+    print(f"Precision Policy: {tf.keras.mixed_precision.global_policy().name}")
+    print(f"JPEG DCT Method: {JPEG_DCT_METHOD or 'default'}")
     print(f"Epochs: {args.epochs}")
     print("=" * 60)
     
@@ -177,6 +312,7 @@ def train_model(args):
     train_dataset = create_dataset_from_gcs(TRAIN_DATA_PATH, is_training=True)
     val_dataset = create_dataset_from_gcs(VAL_DATA_PATH, is_training=False)
     print("✅ Datasets loaded successfully")
+    print(f"   Element spec: {train_dataset.element_spec}")
     
     # Create model
     print("\n🏗️  Building model...")
@@ -184,11 +320,13 @@ def train_model(args):
     
     # Compile model
     model.compile(
-        optimizer=tf.keras.optimizers.Adam(learning_rate=args.learning_rate),
-        loss='categorical_crossentropy',
+        optimizer=tf.keras.mixed_precision.LossScaleOptimizer(
+            tf.keras.optimizers.Adam(learning_rate=args.learning_rate)
+        ),
+        loss='sparse_categorical_crossentropy',
         metrics=[
             'accuracy',
-            tf.keras.metrics.TopKCategoricalAccuracy(k=3, name='top_3_accuracy')
+            tf.keras.metrics.SparseTopKCategoricalAccuracy(k=3, name='top_3_accuracy')
         ]
     )
     
@@ -236,34 +374,98 @@ def train_model(args):
         verbose=1
     )
     
-    # Phase 2: Fine-tune with unfrozen base
-    print("\n🎓 Phase 2: Fine-tuning with unfrozen base model...")
+    # Phase 2: Fine-tune with unfrozen base, pruning weights to the target sparsity
+    print("\n🎓 Phase 2: Fine-tuning with unfrozen base model and pruning...")
     base_model.trainable = True
+    # Keep the base model's BatchNorm statistics frozen while fine-tuning
+    for layer in base_model.layers:
+        if isinstance(layer, layers.BatchNormalization):
+            layer.trainable = False
+    
+    train_examples = args.train_examples or count_records(TRAIN_DATA_PATH)
+    steps_per_epoch = math.ceil(train_examples / BATCH_SIZE)
+    pruning_ramp_epochs = max(1, int(args.epochs // 2 * PRUNING_RAMP_FRACTION))
+    pruning_end_step = steps_per_epoch * pruning_ramp_epochs
+    print(f"   Pruning to {PRUNING_SPARSITY:.0%} sparsity over {pruning_end_step} steps ({train_examples} examples)")
+    model = apply_pruning(model, pruning_end_step)
     
     # Recompile with lower learning rate
     model.compile(
-        optimizer=tf.keras.optimizers.Adam(learning_rate=args.learning_rate / 10),
-        loss='categorical_crossentropy',
+        optimizer=tf.keras.mixed_precision.LossScaleOptimizer(
+            tf.keras.optimizers.Adam(learning_rate=args.learning_rate / 10)
+        ),
+        loss='sparse_categorical_crossentropy',
         metrics=[
             'accuracy',
-            tf.keras.metrics.TopKCategoricalAccuracy(k=3, name='top_3_accuracy')
+            tf.keras.metrics.SparseTopKCategoricalAccuracy(k=3, name='top_3_accuracy')
         ]
     )
     
+    # val_loss rises while weights are being cut, so early stopping only watches the
+    # epochs after the ramp; restoring a mid-ramp epoch would bring back its less sparse masks
+    pruning_callbacks = [
+        callback for callback in model_callbacks if not isinstance(callback, callbacks.EarlyStopping)
+    ] + [
+        callbacks.EarlyStopping(
+            monitor='val_loss',
+            patience=5,
+            restore_best_weights=True,
+            start_from_epoch=pruning_ramp_epochs,
+            verbose=1
+        ),
+        tfmot.sparsity.keras.UpdatePruningStep()
+    ]
+    
     history2 = model.fit(
         train_dataset,
         epochs=args.epochs // 2,
         validation_data=val_dataset,
+        callbacks=pruning_callbacks,
+        verbose=1
+    )
+    model = tfmot.sparsity.keras.strip_pruning(model)
+    sparsity = measure_sparsity(model)
+    print(f"   Achieved sparsity: {sparsity:.1%} (target {PRUNING_SPARSITY:.0%})")
+    if sparsity < PRUNING_SPARSITY - 0.01:
+        print("⚠️  Pruning stopped short of the target sparsity")
+    
+    # Phase 3: Quantization-aware training that preserves the pruned sparsity
+    print("\n🎓 Phase 3: Quantization-aware training...")
+    model = apply_quantization_aware_training(model)
+    
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=args.learning_rate / 100),
+        loss='sparse_categorical_crossentropy',
+        metrics=[
+            'accuracy',
+            tf.keras.metrics.SparseTopKCategoricalAccuracy(k=3, name='top_3_accuracy')
+        ]
+    )
+    
+    history3 = model.fit(
+        train_dataset,
+        epochs=args.qat_epochs,
+        validation_data=val_dataset,
         callbacks=model_callbacks,
         verbose=1
     )
     
-    # Save final model
+    # Save final model, taking [0, 1] inputs like every model the API serves
     print("\n💾 Saving model...")
+    serving_model = build_serving_model(model)
     model_path = os.path.join(MODEL_DIR, 'saved_model')
-    model.save(model_path)
+    serving_model.save(model_path)
     print(f"✅ Model saved to {model_path}")
     
+    # Convert the QAT model to an INT8 TFLite model for CPU serving
+    # (int8 weights and ops, float32 [0, 1] input like the SavedModel)
+    converter = tf.lite.TFLiteConverter.from_keras_model(serving_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    tflite_path = os.path.join(MODEL_DIR, 'model_int8.tflite')
+    with open(tflite_path, 'wb') as f:
+        f.write(converter.convert())
+    print(f"✅ INT8 TFLite model saved to {tflite_path}")
+    
     # Save class names
     class_names_path = os.path.join(MODEL_DIR, 'class_names.json')
     with open(class_names_path, 'w') as f:
@@ -282,7 +484,8 @@ def train_model(args):
     metrics = {
         'loss': float(results[0]),
         'accuracy': float(results[1]),
-        'top_3_accuracy': float(results[2])
+        'top_3_accuracy': float(results[2]),
+        'sparsity': float(sparsity)
     }
     metrics_path = os.path.join(MODEL_DIR, 'metrics.json')
     with open(metrics_path, 'w') as f:
@@ -297,6 +500,9 @@ if __name__ == "__main__":
     parser.add_argument('--epochs', type=int, default=EPOCHS, help='Number of training epochs')
     parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Batch size')
     parser.add_argument('--learning-rate', type=float, default=LEARNING_RATE, help='Learning rate')
+    parser.add_argument('--qat-epochs', type=int, default=QAT_EPOCHS, help='Quantization-aware training epochs')
+    parser.add_argument('--train-examples', type=int, default=None,
+                        help='Training set size for the pruning schedule (counted from the TFRecords if omitted)')
     
     args = parser.parse_args()
     